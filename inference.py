@@ -162,7 +162,8 @@ def main(args):
         embedding_dropout=args.embedding_dropout,
         latent_size=args.latent_size,
         num_layers=args.num_layers,
-        bidirectional=args.bidirectional
+        bidirectional=args.bidirectional,
+        tie_weights=args.tie_weights
     )
 
     model.load_state_dict(
@@ -187,10 +188,16 @@ def main(args):
         if args.constraint_mode:
             actor = actor.cuda() # TODO: to(self.devices)
 
+    # int8 dynamic quantization only runs on the cpu, use fp16 on the gpu
+    if args.quantize:
+        model.quantize_outputs2vocab(
+            torch.float16 if torch.cuda.is_available() else torch.qint8)
+
     if args.sample:
         print('*** SAMPLE Z: ***')
         # get samples from the prior
-        sample_sents, z = model.inference(n=args.num_samples)
+        sample_sents, z = model.inference(
+            n=args.num_samples, beam_size=args.beam_size, max_batch_size=args.max_batch_size)
         sample_sents, sample_tags = get_sents_and_tags(sample_sents, i2w, w2i)
         pickle_it(z.cpu().numpy(), 'samples/z_sample_n{}.pkl'.format(args.num_samples))
         pickle_it(sample_sents, 'samples/sents_sample_n{}.pkl'.format(args.num_samples))
@@ -213,7 +220,8 @@ def main(args):
                 z_prime = actor.forward(z, labels)
 
                 sample_sents_prime, z_prime = model.inference(
-                    z=z_prime, n=args.num_samples)
+                    z=z_prime, n=args.num_samples, beam_size=args.beam_size,
+                    max_batch_size=args.max_batch_size)
                 sample_sents_prime, sample_tags_prime = get_sents_and_tags(
                     sample_sents_prime, i2w, w2i)
                 print('conditoned on: {}'.format(condition))
@@ -232,7 +240,8 @@ def main(args):
         z = to_var(torch.from_numpy(interpolate(start=z1, end=z2, steps=args.num_samples-2)).float())
 
         print('*** INTERP Z: ***')
-        interp_sents, _ = model.inference(z=z)
+        interp_sents, _ = model.inference(
+            z=z, beam_size=args.beam_size, max_batch_size=args.max_batch_size)
         interp_sents, interp_tags = get_sents_and_tags(interp_sents, i2w, w2i)
         pickle_it(z.cpu().numpy(), 'samples/z_interp_n{}.pkl'.format(args.num_samples))
         pickle_it(interp_sents, 'samples/sents_interp_n{}.pkl'.format(args.num_samples))
@@ -254,7 +263,8 @@ def main(args):
                 z_prime = actor.forward(z, labels)
 
                 interp_sents_prime, z_prime = model.inference(
-                    z=z_prime, n=args.num_samples)
+                    z=z_prime, n=args.num_samples, beam_size=args.beam_size,
+                    max_batch_size=args.max_batch_size)
                 interp_sents_prime, interp_tags_prime = get_sents_and_tags(
                     interp_sents_prime, i2w, w2i)
                 print('conditoned on: {}'.format(condition))
@@ -287,6 +297,7 @@ if __name__ == '__main__':
     parser.add_argument('-ls', '--latent_size', type=int, default=16)
     parser.add_argument('-nl', '--num_layers', type=int, default=1)
     parser.add_argument('-bi', '--bidirectional', action='store_true')
+    parser.add_argument('-tw', '--tie_weights', action='store_true')
 
     # conditional specific stuff
     parser.add_argument('-t',  '--n_tags', type=int, default=6)
@@ -296,6 +307,9 @@ if __name__ == '__main__':
     # outputs
     parser.add_argument('-s', '--sample', action='store_true')
     parser.add_argument('-i', '--interpolate', action='store_true')
+    parser.add_argument('-b', '--beam_size', type=int, default=1)
+    parser.add_argument('-mb', '--max_batch_size', type=int, default=None)
+    parser.add_argument('-q', '--quantize', action='store_true')
 
     args = parser.parse_args()
     args.rnn_type = args.rnn_type.lower()
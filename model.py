@@ -1,11 +1,63 @@
 from torch.nn.utils import spectral_norm
-from utils import to_var
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.utils.rnn as rnn_utils
 
 
+@torch.jit.script
+def _decode_step(logits, alive, eos_idx: int, pad_idx: int):
+    """
+    greedily picks the next token from the decoder logits. sequences that
+    already emitted <eos> get <pad>, and alive is cleared for sequences that
+    emit <eos> now. scripted so the argmax, masking and comparisons run as
+    fused ops instead of one python dispatch each.
+    """
+    sample = logits.argmax(dim=-1).view(-1).masked_fill(~alive, pad_idx)
+    alive = alive & (sample != eos_idx)
+
+    return sample, alive
+
+
+@torch.jit.script
+def _reparameterize(mean, logv):
+    """
+    z = mean + eps * exp(0.5 * logv). eps is drawn on the device of mean, and
+    the scale and shift are a single addcmul the fuser can merge with the exp.
+    """
+    std = torch.exp(0.5 * logv)
+    eps = torch.randn_like(mean)
+
+    return torch.addcmul(mean, eps, std)
+
+
+_COMPILED = {}
+
+
+def _compiled(fn):
+    """
+    torch.compile'd version of an unbound method of the model. cached here
+    rather than on the model so the compiled callables are shared across
+    instances and never end up in its pickled state.
+    """
+    if fn not in _COMPILED:
+        _COMPILED[fn] = torch.compile(fn, dynamic=True)
+
+    return _COMPILED[fn]
+
+
+@torch.jit.script
+def _word_dropout_mask(x, rate: float, sos_idx: int, pad_idx: int):
+    """
+    marks tokens of x to be replaced with <unk> with probability rate, never
+    touching <sos> or <pad>. the mask is drawn on the device of x.
+    """
+    protected = (x == sos_idx) | (x == pad_idx)
+
+    return (torch.rand_like(x, dtype=torch.float) < rate) & ~protected
+
+
 class LinearBatch(nn.Module):
     def __init__(self, input_dim, output_dim, bias=True):
         super(LinearBatch, self).__init__()
@@ -28,15 +80,21 @@ class LinearSpec(nn.Module):
 
 class SentenceVAE(nn.Module):
     def __init__(self, vocab_size, embedding_size, rnn_type, hidden_size, word_dropout, embedding_dropout, latent_size,
-                sos_idx, eos_idx, pad_idx, unk_idx, max_sequence_length, num_layers=1, bidirectional=False):
+                sos_idx, eos_idx, pad_idx, unk_idx, max_sequence_length, num_layers=1, bidirectional=False, use_amp=False,
+                tie_weights=False, use_compile=False):
         super().__init__()
-        self.tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.Tensor
+        self.use_amp = use_amp
+        self.use_compile = use_compile
 
         self.max_sequence_length = max_sequence_length
         self.sos_idx = sos_idx
         self.eos_idx = eos_idx
         self.pad_idx = pad_idx
         self.unk_idx = unk_idx
+
+        # follows the model across devices, so sampling never builds its
+        # start tokens on the host. not saved with the state dict
+        self.register_buffer('_sos_tok', torch.tensor(sos_idx, dtype=torch.long), persistent=False)
         self.latent_size = latent_size
         self.rnn_type = rnn_type
         self.bidirectional = bidirectional
@@ -63,181 +121,405 @@ class SentenceVAE(nn.Module):
         self.hidden2mean = nn.Linear(hidden_size * self.hidden_factor, latent_size)
         self.hidden2logv = nn.Linear(hidden_size * self.hidden_factor, latent_size)
         self.latent2hidden = nn.Linear(latent_size, hidden_size * self.hidden_factor)
-        self.outputs2vocab = nn.Linear(hidden_size * (2 if bidirectional else 1), vocab_size)
+
+        output_size = hidden_size * (2 if bidirectional else 1)
+        if tie_weights:
+            # share the [vocab, embedding] matrix between the input embedding
+            # and the output projection. rnn outputs that are not
+            # embedding_size wide are projected down to it first
+            vocab_projection = nn.Linear(embedding_size, vocab_size)
+            vocab_projection.weight = self.embedding.weight
+            if output_size == embedding_size:
+                self.outputs2vocab = vocab_projection
+            else:
+                self.outputs2vocab = nn.Sequential(
+                    nn.Linear(output_size, embedding_size, bias=False), vocab_projection)
+        else:
+            self.outputs2vocab = nn.Linear(output_size, vocab_size)
+
+        # reduced precision copy of outputs2vocab for sampling, see
+        # quantize_outputs2vocab
+        self.outputs2vocab_q = None
+
+
+    def _call(self, fn, *args):
+        """
+        fn(self, *args), through torch.compile when use_compile is set.
+        pack_padded_sequence and the rnns break the graph, so only the chains
+        of small ops between them are compiled: _hidden2gaussian,
+        _decoder_inputs, _vocab_scores and, for greedy decoding,
+        _greedy_sample after the eager decoder_rnn (a dynamically quantized
+        outputs2vocab still breaks it). dynamic shapes avoid a recompile for
+        every batch size and sequence length.
+        """
+        if self.use_compile:
+            fn = _compiled(fn)
+
+        return fn(self, *args)
+
+
+    def _flatten_hidden(self, hidden):
+        """[hidden_factor, bs, hidden_size] -> [bs, hidden_factor*hidden_size]"""
+        bs = hidden.size(1)
+        return hidden.transpose(0, 1).contiguous().view(bs, self.hidden_factor*self.hidden_size)
+
+
+    def _unflatten_hidden(self, hidden):
+        """[bs, hidden_factor*hidden_size] -> [hidden_factor, bs, hidden_size]"""
+        bs = hidden.size(0)
+        return hidden.view(bs, self.hidden_factor, self.hidden_size).transpose(0, 1).contiguous()
 
 
     def encoder(self, x, sorted_lengths):
         """
         encodes x to produce a mean an log variance
         """
-        bs = x.size(0)
         x_embed = self.embedding(x)
         x_packed = rnn_utils.pack_padded_sequence(
-            x_embed, sorted_lengths.data.tolist(), batch_first=True)
+            x_embed, sorted_lengths, batch_first=True, enforce_sorted=True)
         _, hidden = self.encoder_rnn(x_packed)
-
-        # flatten hidden state
-        if self.bidirectional or self.num_layers > 1:
-            hidden = hidden.view(bs, self.hidden_size*self.hidden_factor)
-        else:
-            hidden = hidden.squeeze()
+        mean, logv = self._call(SentenceVAE._hidden2gaussian, hidden)
 
         # returns mean, logv of hidden and context for the decoder
-        return(x, x_embed, self.hidden2mean(hidden), self.hidden2logv(hidden))
+        return(x, x_embed, mean, logv)
+
+
+    def _hidden2gaussian(self, hidden):
+        """
+        mean and log variance from the final encoder hidden state, in fp32
+        for the exp in reparameterize and for the KL term
+        """
+        hidden = self._flatten_hidden(hidden)
+        return self.hidden2mean(hidden).float(), self.hidden2logv(hidden).float()
 
 
-    def reparameterize(self, batch_size, mean, logv):
+    def reparameterize(self, mean, logv):
         """
         uses mean + log variance to generate samples from a gaussian
         parameterized by those values
         """
-        std = torch.exp(0.5 * logv) # std = logvar.mul(0.5).exp_() ??
-        z = to_var(torch.randn([batch_size, self.latent_size]))
-        z = z.mul(std).add_(mean)
+        return(_reparameterize(mean, logv))
 
-        return(z)
 
+    def decoder(self, x, x_embed, z, sorted_lengths, sorted_idx, reversed_idx, return_logits=False):
+        """
+        decodes a sentence from a set of samples. returns the log
+        probabilities (or the raw logits if return_logits, for use with
+        cross_entropy) as a PackedSequence over the non-padded tokens
+        """
+        hidden, x_embed = self._call(SentenceVAE._decoder_inputs, x, x_embed, z)
+        packed_x = rnn_utils.pack_padded_sequence(
+            x_embed, sorted_lengths, batch_first=True, enforce_sorted=True)
 
-    def decoder(self, x, x_embed, z, sorted_lengths, sorted_idx):
-        """decodes a sentence from a set of samples """
-        bs = x.size(0)
-        hidden = self.latent2hidden(z)
+        # decoder forward pass
+        x_tilde, _ = self.decoder_rnn(packed_x, hidden)
 
-        if self.bidirectional or self.num_layers > 1:
-            # unflatten hidden state
-            hidden = hidden.view(self.hidden_factor, bs, self.hidden_size)
-        else:
-            hidden = hidden.unsqueeze(0)
+        # project the packed outputs to vocab, skipping the padded positions
+        logp = self._call(SentenceVAE._vocab_scores, x_tilde.data, return_logits)
+
+        # sorted_indices lets pad_packed_sequence restore the batch order
+        logp = rnn_utils.PackedSequence(logp, x_tilde.batch_sizes, sorted_idx, reversed_idx)
+
+        return(logp)
+
+
+    def _decoder_inputs(self, x, x_embed, z):
+        """initial hidden state from z, and the (word) dropped out embeddings"""
+        hidden = self._unflatten_hidden(self.latent2hidden(z))
 
-        # decoder input
         if self.word_dropout_rate > 0:
 
-            # randomly replace decoder input with <unk>
-            prob = torch.rand(x.size())
+            # randomly replace decoder input with <unk>. the encoder already
+            # embedded x, so only the dropped positions are overwritten
+            # rather than embedding the whole sequence again
+            drop_mask = _word_dropout_mask(
+                x, self.word_dropout_rate, self.sos_idx, self.pad_idx)
+            x_embed = torch.where(
+                drop_mask.unsqueeze(2), self.embedding.weight[self.unk_idx], x_embed)
 
-            if torch.cuda.is_available():
-                prob=prob.cuda()
+        return hidden, self.embedding_dropout(x_embed)
 
-            prob[(x.data - self.sos_idx) * (x.data - self.pad_idx) == 0] = 1
-            decoder_x = x.clone()
-            decoder_x[prob < self.word_dropout_rate] = self.unk_idx
-            x_embed = self.embedding(decoder_x)
 
-        x_embed = self.embedding_dropout(x_embed)
-        packed_x = rnn_utils.pack_padded_sequence(
-            x_embed, sorted_lengths.data.tolist(), batch_first=True)
+    def _vocab_scores(self, outputs, return_logits=False):
+        """vocab logits, or log probabilities, of the flat decoder outputs"""
+        logp = self.outputs2vocab(outputs)
+        if not return_logits:
+            logp = nn.functional.log_softmax(logp, dim=-1)
+
+        return logp
 
-        # decoder forward pass
-        x_tilde, _ = self.decoder_rnn(packed_x, hidden)
 
-        # process outputs
-        x_tilde = rnn_utils.pad_packed_sequence(x_tilde, batch_first=True)[0]
-        x_tilde = x_tilde.contiguous()
-        _, reversed_idx = torch.sort(sorted_idx)
-        x_tilde = x_tilde[reversed_idx]
-        b, s, _ = x_tilde.size()
+    def flatten_parameters(self):
+        """
+        makes the rnn weights a single contiguous chunk so cudnn can use its
+        fused kernels. on cuda this copies every rnn weight into a new
+        buffer, so it is only called when training
+        """
+        self.encoder_rnn.flatten_parameters()
+        self.decoder_rnn.flatten_parameters()
 
-        # project outputs to vocab
-        logp = nn.functional.log_softmax(self.outputs2vocab(
-            x_tilde.view(-1, x_tilde.size(2))), dim=-1)
-        logp = logp.view(b, s, self.embedding.num_embeddings)
 
-        return(logp)
+    def autocast(self, device):
+        """
+        bf16 autocast context for the encoder/decoder when use_amp is set.
+        bf16 has the range of fp32, so no GradScaler is needed
+        """
+        return torch.autocast(device.type, dtype=torch.bfloat16, enabled=self.use_amp)
+
+
+    def forward(self, input_seq, length, return_logits=False):
+        """
+        input_seq may be given on the cpu, ideally from a DataLoader with
+        pin_memory=True, and is then copied to the model without blocking.
+        length is expected on the cpu
+        """
+        if self.training:
+            self.flatten_parameters()
 
+        device = self.embedding.weight.device
+        if input_seq.device != device:
+            input_seq = input_seq.to(device, non_blocking=True)
 
-    def forward(self, input_seq, length):
+        # lengths are only consumed by pack_padded_sequence, which wants them
+        # on the cpu; sorting the few ints there avoids a device sort and a
+        # sync per batch. only the permutation goes to the device
+        sorted_lengths, sorted_idx = torch.sort(length.cpu(), descending=True)
 
-        batch_size = input_seq.size(0)
-        sorted_lengths, sorted_idx = torch.sort(length, descending=True)
-        input_seq = input_seq[sorted_idx]
+        # inverse permutation, a scatter instead of sorting sorted_idx again
+        reversed_idx = torch.empty_like(sorted_idx)
+        reversed_idx[sorted_idx] = torch.arange(len(sorted_idx))
 
-        x, x_embed, mean, logvar = self.encoder(input_seq, sorted_lengths)
-        z = self.reparameterize(batch_size, mean, logvar)
-        logp = self.decoder(x, x_embed, z, sorted_lengths, sorted_idx)
+        sorted_idx = sorted_idx.to(device, non_blocking=True)
+        reversed_idx = reversed_idx.to(device, non_blocking=True)
+        input_seq = input_seq.index_select(0, sorted_idx)
+
+        with self.autocast(input_seq.device):
+            x, x_embed, mean, logvar = self.encoder(input_seq, sorted_lengths)
+            z = self.reparameterize(mean, logvar)
+            logp = self.decoder(x, x_embed, z, sorted_lengths, sorted_idx, reversed_idx, return_logits)
 
         return(logp, mean, logvar, z)
 
 
-    def inference(self, n=4, z=None):
+    def inference(self, n=4, z=None, beam_size=1, max_batch_size=None):
 
         if z is None:
-            batch_size = n
-            z = to_var(torch.randn([batch_size, self.latent_size]))
-        else:
-            batch_size = z.size(0)
+            z = torch.randn([n, self.latent_size], device=self._sos_tok.device)
 
-        hidden = self.latent2hidden(z)
+        with self.autocast(z.device):
+            if beam_size > 1:
+                generations = self._beam_search(z, beam_size, max_batch_size)
+            else:
+                generations = self._greedy_search(z)
 
-        if self.bidirectional or self.num_layers > 1:
-            # unflatten hidden state
-            hidden = hidden.view(self.hidden_factor, batch_size, self.hidden_size)
-
-        hidden = hidden.unsqueeze(0)
+        return generations, z
 
-        # required for dynamic stopping of sentence generation
-        sequence_idx = torch.arange(0, batch_size, out=self.tensor()).long() # all idx of batch
-        sequence_running = torch.arange(0, batch_size, out=self.tensor()).long() # all idx of batch which are still generating
-        sequence_mask = torch.ones(batch_size, out=self.tensor()).byte()
 
-        running_seqs = torch.arange(0, batch_size, out=self.tensor()).long() # idx of still generating sequences with respect to current loop
+    def _greedy_search(self, z, check_every=8):
+        """
+        greedy decoding. the batch keeps a fixed shape for every step:
+        sequences that have emitted <eos> keep being decoded but only write
+        <pad>, so no tensor is resized or re-indexed inside the loop. whether
+        any sequence is still running needs a device sync, so it is only
+        checked every check_every steps
+        """
+        batch_size = z.size(0)
+        hidden = self._unflatten_hidden(self.latent2hidden(z))
 
-        generations = self.tensor(batch_size, self.max_sequence_length).fill_(self.pad_idx).long()
+        device = self._sos_tok.device
+        generations = torch.full((batch_size, self.max_sequence_length), self.pad_idx, dtype=torch.long, device=device)
+        alive = torch.ones(batch_size, dtype=torch.bool, device=device)
+        input_sequence = self._sos_tok.expand(batch_size)
 
-        t=0
-        while(t<self.max_sequence_length and len(running_seqs)>0):
+        for t in range(self.max_sequence_length):
+            input_sequence, hidden, alive = self._greedy_step(input_sequence, hidden, alive)
+            generations[:, t] = input_sequence
 
-            if t == 0:
-                input_sequence = to_var(torch.Tensor(batch_size).fill_(self.sos_idx).long())
+            if (t + 1) % check_every == 0 and not alive.any():
+                break
 
-            input_sequence = input_sequence.unsqueeze(1)
-            input_embedding = self.embedding(input_sequence)
-            output, hidden = self.decoder_rnn(input_embedding, hidden)
-            logits = self.outputs2vocab(output)
-            input_sequence = self._sample(logits)
+        return generations
 
-            # save next input
-            generations = self._save_sample(generations, input_sequence, sequence_running, t)
 
-            # update gloabl running sequence
-            sequence_mask[sequence_running] = (input_sequence != self.eos_idx).data
-            sequence_running = sequence_idx.masked_select(sequence_mask)
+    def _greedy_step(self, input_sequence, hidden, alive):
+        """one fixed-shape greedy decoding step for the whole batch"""
+        input_embedding = self.embedding(input_sequence.unsqueeze(1))
+        output, hidden = self.decoder_rnn(input_embedding, hidden)
+        input_sequence, alive = self._call(SentenceVAE._greedy_sample, output, alive)
 
-            # update local running sequences
-            running_mask = (input_sequence != self.eos_idx).data
-            running_seqs = running_seqs.masked_select(running_mask)
+        return input_sequence, hidden, alive
 
-            # prune input and hidden state according to local update
-            if len(running_seqs) > 0:
-                input_sequence = input_sequence[running_seqs]
-                hidden = hidden[:, running_seqs]
-                running_seqs = torch.arange(0, len(running_seqs), out=self.tensor()).long()
-            t += 1
 
-        return generations, z
+    def _greedy_sample(self, output, alive):
+        """next tokens and alive mask from the decoder rnn output"""
+        logits = self._project_to_vocab(output)
 
+        return _decode_step(logits, alive, self.eos_idx, self.pad_idx)
 
-    def _sample(self, dist, mode='greedy'):
 
-        if mode == 'greedy':
-            _, sample = torch.topk(dist, 1, dim=-1)
-        sample = sample.squeeze()
+    def _beam_search(self, z, beam_size, max_batch_size=None, check_every=8):
+        """
+        batched beam search. the beams of every sequence are folded into the
+        batch dimension so each step is a single decoder_rnn call followed by
+        one topk over [slots, beam_size*vocab]. each step only stores the new
+        tokens and their parent beams; hypotheses are backtracked once a slot
+        is done. at most max_batch_size sequences are decoded at once; when
+        all beams of a slot have emitted <eos>, the best hypothesis is saved
+        and the slot is refilled with the next pending latent, keeping the
+        batch dense. as in greedy decoding, finished slots are only looked
+        for every check_every steps to avoid a device sync per step
+        """
+        n = z.size(0)
+        n_slots = min(n, max_batch_size or n)
+        vocab_size = self.embedding.num_embeddings
+        device = z.device
+
+        generations = torch.full((n, self.max_sequence_length), self.pad_idx, dtype=torch.long, device=device)
+
+        # start scores: only beam 0 is live at t=0 so the first topk does not
+        # pick the same token beam_size times
+        init_scores = torch.full((beam_size,), -float('inf'), device=device)
+        init_scores[0] = 0
+
+        # keeps finished beams alive at a constant score, emitting <pad>
+        finished_logp = torch.full((vocab_size,), -float('inf'), device=device)
+        finished_logp[self.pad_idx] = 0
+
+        def init_slots(idx):
+            k = len(idx)
+            hidden = self._unflatten_hidden(self.latent2hidden(z[idx]))
+            hidden = hidden.repeat_interleave(beam_size, dim=1)
+            return {
+                'sample_idx': idx,
+                't': torch.zeros(k, dtype=torch.long, device=device),
+                'hidden': hidden,
+                'scores': init_scores.repeat(k, 1),
+                'tokens': torch.full((k, beam_size, self.max_sequence_length), self.pad_idx, dtype=torch.long, device=device),
+                'parents': torch.zeros(k, beam_size, self.max_sequence_length, dtype=torch.long, device=device),
+                'finished': torch.zeros(k, beam_size, dtype=torch.bool, device=device),
+                'input': torch.full((k * beam_size,), self.sos_idx, dtype=torch.long, device=device),
+            }
+
+        def cat_slots(a, b):
+            return {key: torch.cat((a[key], b[key]), dim=1 if key == 'hidden' else 0) for key in a}
+
+        def select_slots(state, keep):
+            keep_beams = (keep.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+            out = {}
+            for key, value in state.items():
+                if key == 'hidden':
+                    out[key] = value.index_select(1, keep_beams)
+                elif key == 'input':
+                    out[key] = value.index_select(0, keep_beams)
+                else:
+                    out[key] = value.index_select(0, keep)
+            return out
+
+        def backtrack(tokens, parents, t):
+            # follows the backpointers of beam 0, which topk keeps as the best
+            k = tokens.size(0)
+            slot = torch.arange(k, device=device)
+            beam = torch.zeros(k, dtype=torch.long, device=device)
+            best = torch.full((k, self.max_sequence_length), self.pad_idx, dtype=torch.long, device=device)
+            for step in reversed(range(self.max_sequence_length)):
+                valid = step < t
+                best[:, step] = torch.where(valid, tokens[slot, beam, step], best[:, step])
+                beam = torch.where(valid, parents[slot, beam, step], beam)
+            return best
+
+        state = init_slots(torch.arange(n_slots, device=device))
+        next_pending = n_slots
+
+        # host side step counters, so that no slot is decoded past
+        # max_sequence_length between two checks
+        step = 0
+        starts = [0] * n_slots
+
+        while state['sample_idx'].numel() > 0:
+            k = state['sample_idx'].numel()
+
+            input_embedding = self.embedding(state['input'].unsqueeze(1))
+            output, state['hidden'] = self.decoder_rnn(input_embedding, state['hidden'])
+            logp = F.log_softmax(self._project_to_vocab(output.squeeze(1)), dim=-1)
+            logp = torch.where(state['finished'].view(-1, 1), finished_logp, logp)
+
+            # expand every beam by every token and keep the beam_size best
+            scores = state['scores'].unsqueeze(2) + logp.view(k, beam_size, vocab_size)
+            scores, top_idx = torch.topk(scores.view(k, -1), beam_size, dim=-1)
+            parent = top_idx // vocab_size
+            token = top_idx % vocab_size
+
+            # reorder beams by their parent and record the new token and its
+            # backpointer at step t of every slot
+            parent_flat = (parent + torch.arange(k, device=device).unsqueeze(1) * beam_size).view(-1)
+            state['hidden'] = state['hidden'].index_select(1, parent_flat)
+            t = state['t'].view(k, 1, 1).expand(-1, beam_size, 1)
+            state['tokens'].scatter_(2, t, token.unsqueeze(2))
+            state['parents'].scatter_(2, t, parent.unsqueeze(2))
+            state['finished'] = state['finished'].gather(1, parent) | (token == self.eos_idx)
+            state['scores'] = scores
+            state['input'] = token.view(-1)
+            state['t'] = state['t'] + 1
+            step += 1
+
+            if step % check_every != 0 and step - min(starts) < self.max_sequence_length:
+                continue
+
+            done = state['finished'].all(dim=1) | (state['t'] >= self.max_sequence_length)
+            if not done.any():
+                continue
+
+            done_idx = done.nonzero().view(-1)
+            generations[state['sample_idx'][done_idx]] = backtrack(
+                state['tokens'][done_idx], state['parents'][done_idx], state['t'][done_idx])
+
+            # refill finished slots with pending samples, drop the rest
+            n_refill = min(len(done_idx), n - next_pending)
+            keep = (~done).nonzero().view(-1)
+            state = select_slots(state, keep)
+            starts = [starts[i] for i in keep.tolist()]
+            if n_refill > 0:
+                refill = torch.arange(next_pending, next_pending + n_refill, device=device)
+                state = cat_slots(state, init_slots(refill))
+                starts += [step] * n_refill
+                next_pending += n_refill
+
+        return generations
+
+
+    def quantize_outputs2vocab(self, dtype=torch.qint8):
+        """
+        makes a reduced precision copy of outputs2vocab, the largest layer
+        and the most expensive matmul of every decoding step, which is used
+        by inference in eval mode. torch.qint8 uses dynamic quantization
+        (cpu only), torch.float16 a half precision copy (gpu). call after
+        loading the weights and moving the model to its device.
+
+        the copy is not registered as a submodule, so it stays out of the
+        state dict and parameters() and is not touched by .to() or .float()
+        """
+        if dtype == torch.qint8:
+            outputs2vocab_q = torch.ao.quantization.quantize_dynamic(
+                nn.Sequential(self.outputs2vocab), {nn.Linear}, dtype=torch.qint8)[0]
+        elif dtype == torch.float16:
+            outputs2vocab_q = copy.deepcopy(self.outputs2vocab).half()
+        else:
+            raise ValueError(dtype)
 
-        # fix if sample is a single value, enforce it to be a 1D tensor
-        if len(sample.shape) == 0:
-            sample = sample.view(1)
+        outputs2vocab_q.requires_grad_(False)
+        object.__setattr__(self, 'outputs2vocab_q', outputs2vocab_q)
 
-        return sample
 
+    def _project_to_vocab(self, output):
+        """outputs2vocab, or its quantized copy when sampling"""
+        if self.training or self.outputs2vocab_q is None:
+            return self.outputs2vocab(output)
 
-    def _save_sample(self, save_to, sample, running_seqs, t):
-        # select only still running
-        running_latest = save_to[running_seqs]
-        # update token at position t
-        running_latest[:,t] = sample.data
-        # save back
-        save_to[running_seqs] = running_latest
+        # dynamically quantized layers take fp32 inputs and have no parameters
+        weight = next(self.outputs2vocab_q.parameters(), None)
+        dtype = torch.float if weight is None else weight.dtype
 
-        return save_to
+        return self.outputs2vocab_q(output.to(dtype)).float()
 
 
 class Actor(nn.Module):
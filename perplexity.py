@@ -77,7 +77,7 @@ def unigram(tokens):
 
 
 def load_prime_samples(path):
-    d = np.load(path)
+    d = np.load(path, allow_pickle=True)
     samples = []
     for k, v in d.items():
         samples += v
@@ -102,9 +102,9 @@ def make_corpus(dataset):
 def main(args):
 
     # load samples
-    samples = np.load('samples/sents_sample_n250.pkl')
+    samples = np.load('samples/sents_sample_n250.pkl', allow_pickle=True)
     samples_prime = load_prime_samples('samples/sents_sample_prime_n250.pkl')
-    samples_prime_dict = np.load('samples/sents_sample_prime_n250.pkl')
+    samples_prime_dict = np.load('samples/sents_sample_prime_n250.pkl', allow_pickle=True)
 
     f = open('results/perplexity.csv', 'w')
     f.write('data_type,sample_type,perplexity\n')
@@ -26,6 +26,7 @@ if __name__ == '__main__':
     parser.add_argument('-ls', '--latent_size', type=int, default=16)
     parser.add_argument('-wd', '--word_dropout', type=float, default=0)
     parser.add_argument('-ed', '--embedding_dropout', type=float, default=0.5)
+    parser.add_argument('-tw', '--tie_weights', action='store_true')
 
     parser.add_argument('--no_cuda', action='store_true', default=False, help='disables CUDA')
     parser.add_argument('--batch_size', type=int, default=128)
@@ -80,7 +81,8 @@ if __name__ == '__main__':
         embedding_dropout=args.embedding_dropout,
         latent_size=args.latent_size,
         num_layers=args.num_layers,
-        bidirectional=args.bidirectional
+        bidirectional=args.bidirectional,
+        tie_weights=args.tie_weights
         )
     checkpoint = torch.load(args.vae_path)
     vae_model.load_state_dict(checkpoint)
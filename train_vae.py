@@ -12,9 +12,11 @@ import os
 import sys
 import time
 import torch
+import torch.nn.functional as F
+import torch.nn.utils.rnn as rnn_utils
 
 from ptb import PTB
-from utils import to_var, idx2word, expierment_name
+from utils import idx2word, expierment_name
 from model import SentenceVAE
 import utils
 
@@ -51,11 +53,14 @@ def main(args):
         embedding_dropout=args.embedding_dropout,
         latent_size=args.latent_size,
         num_layers=args.num_layers,
-        bidirectional=args.bidirectional
+        bidirectional=args.bidirectional,
+        use_amp=args.use_amp,
+        tie_weights=args.tie_weights,
+        use_compile=args.use_compile
         )
 
-    if torch.cuda.is_available():
-        model = model.cuda()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
 
     if args.tensorboard_logging:
         writer = SummaryWriter(os.path.join(args.logdir, expierment_name(args,ts)))
@@ -72,15 +77,17 @@ def main(args):
         elif anneal_function == 'linear':
             return min(1, step/x0)
 
-    NLL = torch.nn.NLLLoss(size_average=False, ignore_index=datasets['train'].pad_idx)
-    def loss_fn(logp, target, length, mean, logv, anneal_function, step, k, x0):
+    def loss_fn(logits, target, length, mean, logv, anneal_function, step, k, x0):
 
-        # cut-off unnecessary padding from target, and flatten
-        target = target[:, :torch.max(length).item()].contiguous().view(-1)
-        logp = logp.view(-1, logp.size(2))
+        # pack the target in the same order as the decoder output, and flatten.
+        # length stays on the cpu, as pack_padded_sequence expects
+        sorted_lengths, _ = torch.sort(length, descending=True)
+        target = rnn_utils.pack_padded_sequence(
+            target[logits.sorted_indices], sorted_lengths, batch_first=True).data
 
-        # Negative Log Likelihood
-        NLL_loss = NLL(logp, target)
+        # Negative Log Likelihood, log_softmax is fused into cross_entropy
+        NLL_loss = F.cross_entropy(logits.data.float(), target,
+            ignore_index=datasets['train'].pad_idx, reduction='sum')
 
         # KL Divergence
         KL_loss = -0.5 * torch.sum(1 + logv - mean.pow(2) - logv.exp())
@@ -116,26 +123,50 @@ def main(args):
 
                 batch_size = batch['input'].size(0)
 
-                for k, v in batch.items():
-                    if torch.is_tensor(v):
-                        batch[k] = to_var(v)
-
-                # Forward pass
-                logp, mean, logv, z = model(batch['input'], batch['length'])
-
-                # loss calculation
-                NLL_loss, KL_loss, KL_weight = loss_fn(logp, batch['target'],
-                    batch['length'], mean, logv, args.anneal_function, step, args.k, args.x0)
-
-                loss = (NLL_loss + KL_weight * KL_loss)/batch_size
-
-                # backward + optimization
-                if split == 'train':
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-                    step += 1
-
+                # batches come from pinned memory, so the copies can overlap
+                # with the work still queued on the gpu
+                for key in ['input', 'target']:
+                    batch[key] = batch[key].to(device, non_blocking=True)
+
+                out_of_memory = False
+                try:
+                    # Forward pass
+                    logits, mean, logv, z = model(batch['input'], batch['length'], return_logits=True)
+
+                    # loss calculation
+                    NLL_loss, KL_loss, KL_weight = loss_fn(logits, batch['target'],
+                        batch['length'], mean, logv, args.anneal_function, step, args.k, args.x0)
+
+                    loss = (NLL_loss + KL_weight * KL_loss)/batch_size
+
+                    # backward + optimization
+                    if split == 'train':
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+                        step += 1
+
+                except RuntimeError as e:
+                    if 'out of memory' not in str(e):
+                        raise
+                    out_of_memory = True
+
+                # the cache is emptied outside the except block, whose traceback
+                # still references the failed batch's activations. the outputs
+                # of the previous batch are dropped as well
+                if out_of_memory:
+                    print("%s Batch %04d/%i, out of memory, skipping batch"
+                          %(split.upper(), iteration, len(data_loader)-1))
+                    logits = mean = logv = z = NLL_loss = KL_loss = loss = None
+                    optimizer.zero_grad(set_to_none=True)
+                    torch.cuda.empty_cache()
+                    continue
+
+                # variable length batches fragment the caching allocator, so
+                # periodically return the unused cached blocks
+                if split == 'train' and args.empty_cache_freq > 0 \
+                        and step % args.empty_cache_freq == 0 and torch.cuda.is_available():
+                    torch.cuda.empty_cache()
 
                 # bookkeepeing
                 tracker['ELBO'] = torch.cat((tracker['ELBO'], loss.data.view(1)), dim=0)
@@ -198,12 +229,16 @@ if __name__ == '__main__':
     parser.add_argument('-ls', '--latent_size', type=int, default=16)
     parser.add_argument('-wd', '--word_dropout', type=float, default=0.25)
     parser.add_argument('-ed', '--embedding_dropout', type=float, default=0.5)
+    parser.add_argument('-amp', '--use_amp', action='store_true')
+    parser.add_argument('-tw', '--tie_weights', action='store_true')
+    parser.add_argument('-comp', '--use_compile', action='store_true')
 
     parser.add_argument('-af', '--anneal_function', type=str, default='logistic')
     parser.add_argument('-k', '--k', type=float, default=0.0025)
     parser.add_argument('-x0', '--x0', type=int, default=2500)
 
     parser.add_argument('-v','--print_every', type=int, default=50)
+    parser.add_argument('-ecf','--empty_cache_freq', type=int, default=64)
     parser.add_argument('-tb','--tensorboard_logging', action='store_true')
     parser.add_argument('-log','--logdir', type=str, default='logs')
     parser.add_argument('-bin','--save_model_path', type=str, default='save_model')